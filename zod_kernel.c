@@ -0,0 +1,47 @@
+/*
+ * optional compiled kernel for zod_filter.py.
+ * build it next to the script with :
+ * cc -O3 -march=native -ffast-math -shared -fPIC -o zod_kernel.so zod_kernel.c
+ *
+ * author: frederic wagner (frederic dot wagner at imag dot fr)
+ * license: gplv3
+ */
+
+/*
+ * inflate given points (in place) by given factor if around a spot.
+ * each point is scaled around the first spot it is near to.
+ * inflated[i] is set for each inflated point.
+ */
+void inflate_points(float *__restrict__ points, long points_number,
+                    const float *__restrict__ spots,
+                    const signed char *__restrict__ free_dimensions,
+                    long spots_number, float factor,
+                    unsigned char *__restrict__ inflated)
+{
+    for (long index = 0; index < points_number; index++) {
+        float *point = points + 3 * index;
+        for (long spot = 0; spot < spots_number; spot++) {
+            const float *center = spots + 3 * spot;
+            int free_dimension = free_dimensions[spot];
+            int near_spot = 1;
+#pragma GCC ivdep
+            for (int dimension = 0; dimension < 3; dimension++) {
+                float difference = point[dimension] - center[dimension];
+                if (dimension != free_dimension
+                    && (difference > 2.9f || difference < -2.9f)) {
+                    near_spot = 0;
+                }
+            }
+            if (near_spot) {
+                for (int dimension = 0; dimension < 3; dimension++) {
+                    if (dimension != free_dimension) {
+                        point[dimension] = (point[dimension] - center[dimension]) *
+                            factor + center[dimension];
+                    }
+                }
+                inflated[index] = 1;
+                break;
+            }
+        }
+    }
+}